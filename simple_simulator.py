@@ -3,6 +3,9 @@ import json
 import datetime
 import random
 import hashlib
+import time
+from collections import OrderedDict
+from itertools import islice
 from pathlib import Path
 
 # Ensure data directory exists
@@ -13,6 +16,12 @@ users_file = data_dir / "users.json"
 transactions_file = data_dir / "transactions.json"
 cards_file = data_dir / "cards.json"
 bitcoin_file = data_dir / "bitcoin.json"
+idempotency_file = data_dir / "idempotency.log"
+idempotency_tmp_file = data_dir / "idempotency.log.tmp"
+
+# Replayed requests are remembered for a day, up to a fixed number of keys
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_MAX_KEYS = 10000
 
 # Initialize empty data structures if files don't exist
 if not users_file.exists():
@@ -31,6 +40,9 @@ if not bitcoin_file.exists():
     with open(bitcoin_file, "w") as f:
         json.dump([], f)
 
+if not idempotency_file.exists():
+    idempotency_file.touch()
+
 # Helper functions
 def load_data(file_path):
     with open(file_path, "r") as f:
@@ -49,6 +61,114 @@ def hash_password(password):
 def timestamp():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+# Idempotency operations
+_idempotency_index = None
+_idempotency_log_lines = 0
+
+def get_idempotency_index():
+    # Replay the append-only log once and keep the index in memory; entries
+    # are stored oldest first, so expiry and eviction only touch the front
+    global _idempotency_index, _idempotency_log_lines
+    if _idempotency_index is None:
+        _idempotency_index = OrderedDict()
+        _idempotency_log_lines = 0
+        with open(idempotency_file, "rb+") as f:
+            data = f.read()
+            # Cut off a line torn by a crash mid-write, so the next append
+            # starts on a fresh line instead of being glued onto the fragment
+            if not data.endswith(b"\n"):
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+        for line in data.decode().splitlines():
+            scope, entry = json.loads(line)
+            # A reused key moves to the end, keeping the index oldest first
+            _idempotency_index.pop(scope, None)
+            _idempotency_index[scope] = entry
+            _idempotency_log_lines += 1
+        prune_idempotency_index(time.time())
+    return _idempotency_index
+
+def prune_idempotency_index(now, room=0):
+    index = _idempotency_index
+    
+    # Drop expired entries
+    while index:
+        oldest = next(iter(index.values()))
+        if oldest["expires_at"] > now:
+            break
+        index.popitem(last=False)
+    
+    # Then evict the oldest completed entries until there is room; pending
+    # ones are kept, since dropping them would let a retry apply twice
+    excess = len(index) + room - IDEMPOTENCY_MAX_KEYS
+    if excess > 0:
+        completed = (scope for scope, entry in index.items() if entry["result"] is not None)
+        for scope in list(islice(completed, excess)):
+            del index[scope]
+
+def append_idempotency_log(scope, entry):
+    global _idempotency_log_lines
+    
+    # Compact the log once it holds twice as many lines as the index allows,
+    # so each keyed operation costs one short append on average
+    if _idempotency_log_lines >= 2 * IDEMPOTENCY_MAX_KEYS:
+        # Rewrite into a temporary file first, so a crash part-way through
+        # leaves the old log in place
+        with open(idempotency_tmp_file, "w") as f:
+            for key, value in _idempotency_index.items():
+                f.write(json.dumps([key, value], separators=(",", ":")) + "\n")
+        os.replace(idempotency_tmp_file, idempotency_file)
+        _idempotency_log_lines = len(_idempotency_index)
+        return
+    
+    with open(idempotency_file, "a") as f:
+        f.write(json.dumps([scope, entry], separators=(",", ":")) + "\n")
+    _idempotency_log_lines += 1
+
+def idempotency_scope(operation, user_id, idempotency_key):
+    return f"{operation}:{user_id}:{idempotency_key}"
+
+def check_idempotency_key(scope, fingerprint):
+    # Returns None for a new key, otherwise the (success, result) to replay
+    index = get_idempotency_index()
+    entry = index.get(scope)
+    
+    if entry is None:
+        return None
+    
+    if entry["expires_at"] <= time.time():
+        del index[scope]
+        return None
+    
+    if entry["fingerprint"] != fingerprint:
+        return False, "Idempotency key reused with different parameters"
+    
+    if entry["result"] is None:
+        return False, "A request with this idempotency key is already in progress"
+    
+    return True, entry["result"]
+
+def reserve_idempotency_key(scope, fingerprint):
+    # Recorded as pending before any balance changes, so a crash part-way
+    # through blocks the retry instead of applying the operation twice
+    index = get_idempotency_index()
+    now = time.time()
+    prune_idempotency_index(now, room=1)
+    
+    # Every remaining entry is still pending
+    if len(index) >= IDEMPOTENCY_MAX_KEYS:
+        return False
+    
+    entry = {"fingerprint": fingerprint, "result": None, "expires_at": now + IDEMPOTENCY_TTL}
+    index[scope] = entry
+    append_idempotency_log(scope, entry)
+    return True
+
+def finalize_idempotency_key(scope, result):
+    entry = get_idempotency_index()[scope]
+    entry["result"] = result
+    append_idempotency_log(scope, entry)
+
 # User operations
 def create_user(username, email, cashtag, password):
     users = load_data(users_file)
@@ -107,7 +227,26 @@ def update_balance(user_id, amount):
     return False
 
 # Transaction operations
-def create_transaction(sender_id, receiver_id, amount, note="", transaction_type="payment"):
+def create_transaction(sender_id, receiver_id, amount, note="", transaction_type="payment", idempotency_key=None):
+    # A retried request returns the original transaction instead of applying it twice
+    if idempotency_key:
+        scope = idempotency_scope(transaction_type, sender_id, idempotency_key)
+        fingerprint = [receiver_id, amount, note]
+        replay = check_idempotency_key(scope, fingerprint)
+        if replay is not None:
+            success, result = replay
+            if success:
+                result = {
+                    "id": result["id"],
+                    "sender_id": sender_id,
+                    "receiver_id": receiver_id,
+                    "amount": amount,
+                    "note": note,
+                    "transaction_type": transaction_type,
+                    "timestamp": result["timestamp"]
+                }
+            return success, result
+    
     transactions = load_data(transactions_file)
     sender = get_user_by_id(sender_id)
     receiver = get_user_by_id(receiver_id)
@@ -118,6 +257,9 @@ def create_transaction(sender_id, receiver_id, amount, note="", transaction_type
     if sender["balance"] < amount and transaction_type in ["payment", "withdrawal"]:
         return False, "Insufficient funds"
     
+    if idempotency_key and not reserve_idempotency_key(scope, fingerprint):
+        return False, "Too many requests in progress"
+    
     # Update balances
     if transaction_type in ["payment", "withdrawal"]:
         update_balance(sender_id, -amount)
@@ -138,6 +280,9 @@ def create_transaction(sender_id, receiver_id, amount, note="", transaction_type
     transactions.append(new_transaction)
     save_data(transactions_file, transactions)
     
+    if idempotency_key:
+        finalize_idempotency_key(scope, {"id": new_transaction["id"], "timestamp": new_transaction["timestamp"]})
+    
     return True, new_transaction
 
 def get_user_transactions(user_id):
@@ -250,7 +395,14 @@ def get_bitcoin_price():
     base_price = 30000
     return round(base_price + random.uniform(-1000, 1000), 2)
 
-def buy_bitcoin(user_id, usd_amount):
+def buy_bitcoin(user_id, usd_amount, idempotency_key=None):
+    if idempotency_key:
+        scope = idempotency_scope("buy", user_id, idempotency_key)
+        fingerprint = [usd_amount]
+        replay = check_idempotency_key(scope, fingerprint)
+        if replay is not None:
+            return replay
+    
     bitcoin_wallets = load_data(bitcoin_file)
     user = get_user_by_id(user_id)
     
@@ -269,6 +421,9 @@ def buy_bitcoin(user_id, usd_amount):
     if not wallet:
         return False, "Bitcoin wallet not found"
     
+    if idempotency_key and not reserve_idempotency_key(scope, fingerprint):
+        return False, "Too many requests in progress"
+    
     # Update user balance
     update_balance(user_id, -usd_amount)
     
@@ -291,9 +446,21 @@ def buy_bitcoin(user_id, usd_amount):
     wallet["transactions"].append(transaction)
     save_data(bitcoin_file, bitcoin_wallets)
     
-    return True, {"btc_amount": btc_amount, "usd_amount": usd_amount, "btc_price": btc_price}
+    result = {"btc_amount": btc_amount, "usd_amount": usd_amount, "btc_price": btc_price}
+    
+    if idempotency_key:
+        finalize_idempotency_key(scope, result)
+    
+    return True, result
 
-def sell_bitcoin(user_id, btc_amount):
+def sell_bitcoin(user_id, btc_amount, idempotency_key=None):
+    if idempotency_key:
+        scope = idempotency_scope("sell", user_id, idempotency_key)
+        fingerprint = [btc_amount]
+        replay = check_idempotency_key(scope, fingerprint)
+        if replay is not None:
+            return replay
+    
     bitcoin_wallets = load_data(bitcoin_file)
     
     wallet = None
@@ -308,6 +475,9 @@ def sell_bitcoin(user_id, btc_amount):
     if wallet["btc_balance"] < btc_amount:
         return False, "Insufficient Bitcoin balance"
     
+    if idempotency_key and not reserve_idempotency_key(scope, fingerprint):
+        return False, "Too many requests in progress"
+    
     # Calculate USD amount based on current price
     btc_price = get_bitcoin_price()
     usd_amount = btc_amount * btc_price
@@ -330,7 +500,12 @@ def sell_bitcoin(user_id, btc_amount):
     wallet["transactions"].append(transaction)
     save_data(bitcoin_file, bitcoin_wallets)
     
-    return True, {"btc_amount": btc_amount, "usd_amount": usd_amount, "btc_price": btc_price}
+    result = {"btc_amount": btc_amount, "usd_amount": usd_amount, "btc_price": btc_price}
+    
+    if idempotency_key:
+        finalize_idempotency_key(scope, result)
+    
+    return True, result
 
 # functions
 def demo_run():
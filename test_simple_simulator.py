@@ -0,0 +1,247 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+
+def load_simulator():
+    # The module creates its data files relative to the working directory on import
+    sys.modules.pop("simple_simulator", None)
+    return importlib.import_module("simple_simulator")
+
+
+@pytest.fixture
+def sim(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(Path(__file__).parent))
+    yield load_simulator()
+    sys.modules.pop("simple_simulator", None)
+
+
+@pytest.fixture
+def users(sim):
+    _, alice = sim.create_user("Alice", "alice@example.com", "alice", "secret")
+    _, bob = sim.create_user("Bob", "bob@example.com", "bob", "secret")
+    sim.create_transaction(alice["id"], alice["id"], 100.0, "Added cash", "deposit")
+    return alice["id"], bob["id"]
+
+
+def balance(sim, user_id):
+    return sim.get_user_by_id(user_id)["balance"]
+
+
+def test_replay_returns_original_payment(sim, users):
+    alice, bob = users
+    success, first = sim.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+    transactions = sim.load_data(sim.transactions_file)
+
+    success, replay = sim.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    assert success
+    assert replay == first
+    assert balance(sim, alice) == 50.0
+    assert balance(sim, bob) == 50.0
+    assert sim.load_data(sim.transactions_file) == transactions
+
+
+def test_key_reused_with_different_parameters(sim, users):
+    alice, bob = users
+    sim.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    success, result = sim.create_transaction(alice, bob, 5.0, "lunch", idempotency_key="p1")
+
+    assert not success
+    assert result == "Idempotency key reused with different parameters"
+    assert balance(sim, alice) == 50.0
+
+
+def test_keys_are_scoped_by_operation(sim, users):
+    alice, _ = users
+    sim.create_transaction(alice, alice, 10.0, "", "deposit", idempotency_key="k")
+    sim.create_transaction(alice, alice, 10.0, "", "withdrawal", idempotency_key="k")
+
+    assert balance(sim, alice) == 100.0
+
+
+def test_failed_attempt_is_not_recorded(sim, users):
+    alice, bob = users
+    success, _ = sim.create_transaction(alice, bob, 500.0, "", idempotency_key="p1")
+    assert not success
+
+    sim.create_transaction(alice, alice, 400.0, "", "deposit")
+    success, _ = sim.create_transaction(alice, bob, 500.0, "", idempotency_key="p1")
+
+    assert success
+    assert balance(sim, bob) == 500.0
+
+
+def test_expired_key_applies_again(sim, users, monkeypatch):
+    alice, bob = users
+    now = [1000.0]
+    monkeypatch.setattr(sim.time, "time", lambda: now[0])
+    sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p1")
+
+    now[0] += sim.IDEMPOTENCY_TTL
+    success, _ = sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p1")
+
+    assert success
+    assert balance(sim, bob) == 20.0
+
+
+def test_oldest_key_is_evicted_when_full(sim, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(sim, "IDEMPOTENCY_MAX_KEYS", 2)
+    for key in ("p1", "p2", "p3"):
+        sim.create_transaction(alice, bob, 10.0, "", idempotency_key=key)
+
+    sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p3")
+    assert balance(sim, bob) == 30.0
+
+    sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p1")
+    assert balance(sim, bob) == 40.0
+
+
+def test_index_survives_restart(sim, users):
+    alice, bob = users
+    success, first = sim.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    restarted = load_simulator()
+    success, replay = restarted.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    assert success
+    assert replay == first
+    assert balance(restarted, bob) == 50.0
+
+
+def test_log_is_compacted(sim, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(sim, "IDEMPOTENCY_MAX_KEYS", 2)
+    for key in ("p1", "p2", "p3", "p4"):
+        sim.create_transaction(alice, bob, 1.0, "", idempotency_key=key)
+
+    with open(sim.idempotency_file) as f:
+        assert len(f.readlines()) <= 2 * sim.IDEMPOTENCY_MAX_KEYS
+
+    restarted = load_simulator()
+    restarted.create_transaction(alice, bob, 1.0, "", idempotency_key="p4")
+    assert balance(restarted, bob) == 4.0
+
+
+def crash_after_reservation(sim, monkeypatch, *args, **kwargs):
+    def crash(user_id, amount):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(sim, "update_balance", crash)
+        with pytest.raises(OSError):
+            sim.create_transaction(*args, **kwargs)
+
+
+
+def test_crash_after_reservation_blocks_retry(sim, users, monkeypatch):
+    alice, bob = users
+    crash_after_reservation(sim, monkeypatch, alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    restarted = load_simulator()
+    success, result = restarted.create_transaction(alice, bob, 50.0, "rent", idempotency_key="p1")
+
+    assert not success
+    assert result == "A request with this idempotency key is already in progress"
+    assert balance(restarted, alice) == 100.0
+
+
+def test_bitcoin_replay(sim, users):
+    alice, _ = users
+    success, bought = sim.buy_bitcoin(alice, 30.0, idempotency_key="b1")
+    assert sim.buy_bitcoin(alice, 30.0, idempotency_key="b1") == (True, bought)
+    assert balance(sim, alice) == 70.0
+
+    btc_amount = bought["btc_amount"] / 2
+    success, sold = sim.sell_bitcoin(alice, btc_amount, idempotency_key="s1")
+    assert sim.sell_bitcoin(alice, btc_amount, idempotency_key="s1") == (True, sold)
+    assert sim.sell_bitcoin(alice, btc_amount / 2, idempotency_key="s1") == (
+        False, "Idempotency key reused with different parameters"
+    )
+    assert len(sim.get_bitcoin_wallet(alice)["transactions"]) == 2
+
+
+def test_torn_log_line_is_trimmed(sim, users, monkeypatch):
+    alice, bob = users
+    sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p1")
+    with open(sim.idempotency_file, "a") as f:
+        f.write('["payment:torn",{"finger')
+
+    restarted = load_simulator()
+    crash_after_reservation(restarted, monkeypatch, alice, bob, 10.0, "", idempotency_key="p2")
+
+    restarted = load_simulator()
+    success, result = restarted.create_transaction(alice, bob, 10.0, "", idempotency_key="p2")
+
+    assert not success
+    assert result == "A request with this idempotency key is already in progress"
+    assert balance(restarted, bob) == 10.0
+
+
+def test_pending_key_is_not_evicted(sim, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(sim, "IDEMPOTENCY_MAX_KEYS", 2)
+    crash_after_reservation(sim, monkeypatch, alice, bob, 10.0, "", idempotency_key="p1")
+
+    for key in ("p2", "p3"):
+        success, _ = sim.create_transaction(alice, bob, 1.0, "", idempotency_key=key)
+        assert success
+
+    success, result = sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p1")
+    assert not success
+    assert result == "A request with this idempotency key is already in progress"
+    assert balance(sim, bob) == 2.0
+
+
+def test_reservation_refused_when_all_keys_pending(sim, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(sim, "IDEMPOTENCY_MAX_KEYS", 1)
+    crash_after_reservation(sim, monkeypatch, alice, bob, 10.0, "", idempotency_key="p1")
+
+    success, result = sim.create_transaction(alice, bob, 10.0, "", idempotency_key="p2")
+
+    assert not success
+    assert result == "Too many requests in progress"
+    assert balance(sim, bob) == 0.0
+
+
+def test_failed_compaction_keeps_log(sim, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(sim, "IDEMPOTENCY_MAX_KEYS", 2)
+    for key in ("p1", "p2"):
+        sim.create_transaction(alice, bob, 1.0, "", idempotency_key=key)
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(sim.os, "replace", fail)
+        with pytest.raises(OSError):
+            sim.create_transaction(alice, bob, 1.0, "", idempotency_key="p3")
+
+    restarted = load_simulator()
+    for key in ("p1", "p2"):
+        restarted.create_transaction(alice, bob, 1.0, "", idempotency_key=key)
+    assert balance(restarted, bob) == 2.0
+
+
+def test_reused_key_keeps_order_after_restart(sim, users, monkeypatch):
+    alice, bob = users
+    now = [1000.0]
+    monkeypatch.setattr(sim.time, "time", lambda: now[0])
+    sim.create_transaction(alice, bob, 1.0, "", idempotency_key="k0")
+    now[0] += 1
+    sim.create_transaction(alice, bob, 1.0, "", idempotency_key="k1")
+    now[0] += sim.IDEMPOTENCY_TTL - 0.5
+    sim.create_transaction(alice, bob, 1.0, "", idempotency_key="k0")
+    order = list(sim.get_idempotency_index())
+
+    restarted = load_simulator()
+
+    assert list(restarted.get_idempotency_index()) == order
+    assert order[-1] == f"payment:{alice}:k0"